@@ -1,6 +1,7 @@
 import logging
 import logging.config
 from messagebus import create_app
+from messagebus.profiler import profiler
 from watchdog.events import FileSystemEventHandler
 from watchdog.observers import Observer
 import yaml
@@ -16,6 +17,10 @@ class ConfigChangeHandler(FileSystemEventHandler):
             with open('conf/messagebus.yaml', 'r', encoding="utf-8") as f:
                 config = yaml.safe_load(f)
                 app.config.update(config)
+            # 关闭剖析时把已采集的数据落盘
+            profiling = app.config.get("profiling") or {}
+            if not profiling.get("enabled"):
+                profiler.flush(profiling.get("output", "profiles"))
 
         if event.src_path.endswith("logging.yaml"):
             with open('conf/logging.yaml', 'r', encoding="utf-8") as f:
@@ -0,0 +1,55 @@
+"""编解码路径基准测试
+
+    python bench_codec.py
+
+对比 json/orjson 的编解码、每次新建与缓存 MessageSchema 的校验开销，
+以及上游响应重复解析与单次解析的差异。
+"""
+import json
+import timeit
+from flask.json.provider import DefaultJSONProvider
+from requests import Response
+from messagebus import codec
+from messagebus.codec import get_schema, parse_response
+from messagebus.models import MessageSchema
+
+NUMBER = 20000
+
+payload = {
+    "Message": {
+        "content": "磁盘使用率超过阈值 " * 40,
+        "title": "告警",
+        "category": "告警",
+        "sender": "monitor",
+        "uuid": "6fe4fd9a-4eae-4248-bd6b-d4f1aac75e08",
+    },
+    "extra": {"monkeytalk": ["9871", "9950"], "bocwechat": ["1234567", "9999999"]},
+}
+upstream = Response()
+upstream._content = json.dumps({"code": 200, "msg": "ok", "data": [{"id": i} for i in range(20)]}).encode()
+
+
+def run(label, stmt):
+    seconds = timeit.timeit(stmt, number=NUMBER)
+    print(f"{label:<40}{seconds / NUMBER * 1e6:>10.2f} us/op")
+
+
+def main():
+    raw = json.dumps(payload, ensure_ascii=False)
+    run("json.dumps", lambda: json.dumps(payload, ensure_ascii=False, default=DefaultJSONProvider.default))
+    run("json.loads", lambda: json.loads(raw))
+    if codec.orjson is not None:
+        run("codec.dumps (orjson)", lambda: codec.dumps(payload))
+        run("codec.loads (orjson)", lambda: codec.loads(raw))
+    else:
+        print("orjson not installed, skip orjson cases")
+
+    run("MessageSchema().load", lambda: MessageSchema().load(dict(payload["Message"])))
+    run("get_schema(MessageSchema).load", lambda: get_schema(MessageSchema).load(dict(payload["Message"])))
+
+    run("response.json() x5", lambda: [upstream.json() for _ in range(5)])
+    run("parse_response() x1", lambda: parse_response(upstream))
+
+
+if __name__ == "__main__":
+    main()
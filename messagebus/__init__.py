@@ -38,20 +38,36 @@ def create_app(name):
 
     db.init_app(app)
 
+    from messagebus import codec
+    codec.init_app(app)
+
+    # 性能剖析需要先于其它 before_request 注册，以覆盖完整请求路径
+    from messagebus.profiler import profiler
+    profiler.init_app(app)
+
+    # 幂等重试直接返回保存的响应，不占用配额
+    from messagebus.idempotency import idempotency
+    idempotency.init_app(app)
+
+    # 准入控制先于连接器初始化，被拒绝的请求不再创建连接器
+    from messagebus.admission import admission
+    admission.init_app(app)
+
     # 注册蓝图到应用
     from messagebus.message import message_bp
     app.register_blueprint(message_bp)
 
     @app.before_request
     def create_mbus():
-        from messagebus.mbc import MessageBus, ConnectorFactory
-        g.mbus = MessageBus()
+        from messagebus.mbc import MessageBus
+        g.mbus = MessageBus.from_config(app.config)
         g.uuid = str(uuid.uuid4())
-        channels = app.config.get("channels")
-        for channel in app.config["inuse"]:
-            conf = channels[channel]["default"]
-            conn = ConnectorFactory.get_connector(channel, **conf)
-            g.mbus.register_connector(conn)
+
+    from messagebus.scheduler import scheduler
+    scheduler.init_app(app)
+
+    from messagebus.spool import spool
+    spool.init_app(app)
 
     @app.errorhandler(HTTPException)
     def handle_exception(e):
@@ -0,0 +1,146 @@
+import logging
+import math
+import threading
+import time
+from flask import g, request, current_app
+from sqlalchemy import select, insert, update
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from werkzeug.exceptions import TooManyRequests
+from messagebus import db
+from messagebus.cache import LRUCache
+from messagebus.models import RateBucket
+from messagebus.spool import spool
+
+logger = logging.getLogger('MBus')
+
+
+def refill(tokens, updated_at, now, rate, burst):
+    """令牌桶补充后尝试取出一个令牌
+
+    :return: (是否取得令牌, 剩余令牌数, 需等待的秒数)
+    """
+    tokens = min(burst, tokens + (now - updated_at) * rate)
+    if tokens >= 1:
+        return True, tokens - 1, 0
+    return False, tokens, math.ceil((1 - tokens) / rate) if rate > 0 else 60
+
+
+class MemoryBuckets:
+    """进程内令牌桶，发送者来自请求，按LRU限制桶的数量（被淘汰的桶视为已补满）"""
+
+    def __init__(self, maxsize=10000):
+        self.lock = threading.Lock()
+        self.buckets = LRUCache(maxsize=maxsize)
+
+    def take(self, key, rate, burst):
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated_at = self.buckets.get(key, (burst, now))
+            allowed, tokens, wait = refill(tokens, updated_at, now, rate, burst)
+            self.buckets.set(key, (tokens, now))
+        return allowed, wait
+
+
+class DatabaseBuckets:
+    """ 基于 rate_bucket 表的令牌桶，多进程、多节点共享配额
+        每次取令牌在独立事务中以行锁完成，不影响请求本身的会话
+    """
+
+    def take(self, key, rate, burst):
+        now = time.time()
+        with db.engine.begin() as conn:
+            stmt = select(RateBucket.tokens, RateBucket.updated_at).where(RateBucket.key == key).with_for_update()
+            row = conn.execute(stmt).first()
+            if row is None:
+                try:
+                    with conn.begin_nested():
+                        conn.execute(insert(RateBucket).values(key=key, tokens=burst - 1, updated_at=now))
+                    return True, 0
+                except IntegrityError:
+                    # 并发请求已创建该桶
+                    row = conn.execute(stmt).first()
+            allowed, tokens, wait = refill(row.tokens, row.updated_at, now, rate, burst)
+            conn.execute(update(RateBucket).where(RateBucket.key == key).values(tokens=tokens, updated_at=now))
+        return allowed, wait
+
+
+class Admission:
+    """ /message 入口准入控制
+        按全局与发送者的令牌桶限流，并在在途请求数、本地缓冲积压或连接器延迟超过阈值时
+        提前拒绝，返回429及Retry-After。配置在每个请求读取，支持热加载。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.inflight = 0
+        # 渠道 -> (延迟EWMA, 最近一次观测时间)
+        self.latency = dict()
+        self.backends = {"memory": MemoryBuckets(), "db": DatabaseBuckets()}
+
+    def init_app(self, app):
+        app.before_request(self.admit)
+        app.teardown_request(self.release)
+
+    def admit(self):
+        conf = current_app.config.get("admission")
+        if not conf or not conf.get("enabled") or request.endpoint not in conf.get("endpoints", ["message.message_view"]):
+            return
+
+        self.check_overload(conf)
+
+        buckets = self.backends[conf.get("backend", "memory")]
+        data = request.get_json(silent=True) or {}
+        sender = (data.get("Message") or {}).get("sender") if isinstance(data, dict) else None
+        # 先检查发送者配额，被其拒绝的请求不消耗全局令牌，避免单个发送者耗尽全局配额
+        quotas = []
+        if sender:
+            quotas.append((f"sender:{sender}", (conf.get("senders") or {}).get(sender, conf.get("sender"))))
+        quotas.append(("global", conf.get("global")))
+        for key, quota in quotas:
+            if not quota:
+                continue
+            try:
+                allowed, wait = buckets.take(key, quota["rate"], quota.get("burst", quota["rate"]))
+            except SQLAlchemyError as e:
+                # 配额存储不可用时放行，避免限流本身成为故障点
+                logger.error(f"Admission quota check failed, request admitted. [{e}]")
+                continue
+            if not allowed:
+                logger.warning(f"Request rejected by {key} quota.")
+                raise TooManyRequests(f"Quota of {key} exceeded.", retry_after=wait)
+
+        with self.lock:
+            self.inflight += 1
+        g.admitted = True
+
+    def check_overload(self, conf):
+        retry_after = conf.get("retry_after", 5)
+        if conf.get("max_inflight") and self.inflight >= conf["max_inflight"]:
+            logger.warning(f"Request rejected, {self.inflight} requests in flight.")
+            raise TooManyRequests("Service is overloaded.", retry_after=retry_after)
+
+        if conf.get("max_spool_backlog") and spool.backlog() >= conf["max_spool_backlog"]:
+            logger.warning(f"Request rejected, spool backlog reaches {conf['max_spool_backlog']} bytes.")
+            raise TooManyRequests("Service is overloaded.", retry_after=retry_after)
+
+        if conf.get("max_latency"):
+            now = time.monotonic()
+            for channel, (latency, observed_at) in list(self.latency.items()):
+                # 只参考latency_window内的观测，过期后放行流量以重新测量
+                if now - observed_at < conf.get("latency_window", 10) and latency > conf["max_latency"]:
+                    logger.warning(f"Request rejected, {channel} latency is {latency:.2f}s.")
+                    raise TooManyRequests(f"Channel {channel} is slow.", retry_after=retry_after)
+
+    def release(self, exc=None):
+        if g.pop("admitted", False):
+            with self.lock:
+                self.inflight -= 1
+
+    def observe(self, channel, seconds, alpha=0.2):
+        """记录连接器发送耗时"""
+        with self.lock:
+            latency, _ = self.latency.get(channel, (seconds, 0))
+            self.latency[channel] = (alpha * seconds + (1 - alpha) * latency, time.monotonic())
+
+
+admission = Admission()
@@ -0,0 +1,60 @@
+import json
+import logging
+from functools import cache
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # orjson 为可选依赖
+    orjson = None
+
+logger = logging.getLogger('MBus')
+
+
+def dumps(obj):
+    """序列化为 JSON 字符串，安装了 orjson 时优先使用"""
+    if orjson is not None:
+        return orjson.dumps(obj, default=DefaultJSONProvider.default,
+                            option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, default=DefaultJSONProvider.default)
+
+
+def loads(data):
+    """反序列化 JSON 字符串或字节串"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def parse_response(response):
+    """上游响应只解析一次，之后统一使用返回的字典"""
+    return loads(response.content)
+
+
+@cache
+def get_schema(schema_cls, many=False):
+    """缓存 marshmallow Schema 实例，避免每个请求重复构建字段"""
+    return schema_cls(many=many)
+
+
+class ORJSONProvider(DefaultJSONProvider):
+    """基于 orjson 的 Flask JSON Provider，用于请求解析与响应序列化"""
+
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if kwargs.get("sort_keys", self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+def init_app(app):
+    """根据配置 JSON_PROVIDER 选择 Flask 的 JSON Provider"""
+    if app.config.get("JSON_PROVIDER") != "orjson":
+        return
+    if orjson is None:
+        logger.warning("JSON_PROVIDER is orjson but orjson is not installed, using default provider.")
+        return
+    app.json = ORJSONProvider(app)
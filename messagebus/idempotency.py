@@ -0,0 +1,191 @@
+import json
+import logging
+import threading
+import time
+from hashlib import sha256
+from datetime import datetime, timedelta
+from flask import g, request, current_app
+from sqlalchemy import select, insert, update, delete, or_, and_
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from werkzeug.exceptions import BadRequest, Conflict, UnprocessableEntity
+from messagebus import db
+from messagebus.cache import LRUCache
+from messagebus.models import IdempotencyKey
+from messagebus.spool import spool
+
+logger = logging.getLogger('MBus')
+
+
+class Idempotency:
+    """ 基于 Idempotency-Key 请求头的幂等处理
+        首个请求的响应保存在进程内LRU缓存及 idempotency_key 表中（有效期ttl秒），相同key的重试直接返回保存的响应。
+        同一key的并发请求等待首个请求完成后返回其结果；跨节点时通过表中的pending记录认领。
+        key按发送者隔离，并保存请求体哈希，同一key携带不同请求体时返回422。
+        5xx及429响应不保存，客户端可用同一key重试。
+        开启本地缓冲时只使用进程内缓存，避免数据库重新挡在接收路径上。
+    """
+
+    def __init__(self):
+        self.cache = None
+        self.lock = threading.Lock()
+        self.inflight = dict()
+        self.last_purge = 0
+
+    def init_app(self, app):
+        conf = app.config.get("idempotency") or {}
+        self.cache = LRUCache(maxsize=conf.get("cache_size", 10000), ttl=conf.get("ttl", 86400))
+        app.before_request(self.lookup)
+        app.after_request(self.store)
+        app.teardown_request(self.release)
+
+    def lookup(self):
+        conf = current_app.config.get("idempotency")
+        header = request.headers.get("Idempotency-Key")
+        if not header or not conf or not conf.get("enabled") \
+                or request.endpoint not in conf.get("endpoints", ["message.message_view"]):
+            return
+        if len(header) > 128:
+            raise BadRequest("Idempotency-Key should not exceed 128 characters.")
+
+        data = request.get_json(silent=True)
+        sender = (data.get("Message") or {}).get("sender") if isinstance(data, dict) else None
+        key = f"{sender or ''}:{header}"
+        digest = sha256(json.dumps(data, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
+
+        cached = self.cache.get(key)
+        if cached:
+            return self.replay(key, cached, digest)
+
+        # 同一进程内的并发重复请求等待首个请求
+        with self.lock:
+            event = self.inflight.get(key)
+            if event is None:
+                self.inflight[key] = threading.Event()
+        if event is not None:
+            event.wait(conf.get("wait_timeout", 30))
+            cached = self.cache.get(key)
+            if cached:
+                return self.replay(key, cached, digest)
+            raise Conflict(f"Request with Idempotency-Key {header} is still in progress.")
+
+        g.idempotency_hash = digest
+        # 开启本地缓冲时不访问数据库
+        if spool.enabled:
+            g.idempotency_key = key
+            return
+
+        deadline = time.monotonic() + conf.get("wait_timeout", 30)
+        try:
+            while True:
+                state, stored = self.claim(key, digest, conf)
+                if state == "claimed":
+                    break
+                if state == "done":
+                    self.cache.set(key, stored)
+                    self.finish(key)
+                    return self.replay(key, stored, digest)
+                # 其它节点正在处理
+                if time.monotonic() >= deadline:
+                    self.finish(key)
+                    raise Conflict(f"Request with Idempotency-Key {header} is still in progress.")
+                time.sleep(conf.get("poll_interval", 0.2))
+        except SQLAlchemyError as e:
+            # 存储不可用时仅依赖进程内缓存
+            logger.error(f"Idempotency store is unavailable. [{e}]")
+        g.idempotency_key = key
+
+    def claim(self, key, digest, conf):
+        """认领key，返回 ("claimed", None)、("done", 已保存的响应) 或 ("pending", None)"""
+        now = datetime.now()
+        values = dict(status="pending", uuid=None, status_code=None, response=None, request_hash=digest,
+                      created_at=now, expires_at=now + timedelta(seconds=conf.get("ttl", 86400)))
+        with db.engine.begin() as conn:
+            try:
+                with conn.begin_nested():
+                    conn.execute(insert(IdempotencyKey).values(key=key, **values))
+                return "claimed", None
+            except IntegrityError:
+                pass
+
+            row = conn.execute(select(IdempotencyKey).where(IdempotencyKey.key == key)).first()
+            if row is None:
+                return "pending", None
+            if row.status == "done" and row.expires_at > now:
+                return "done", (row.status_code, row.response, row.uuid, row.request_hash)
+
+            # 已过期或处理者超时未完成时接管
+            stale = now - timedelta(seconds=conf.get("pending_timeout", 60))
+            stmt = update(IdempotencyKey).where(
+                IdempotencyKey.key == key,
+                or_(IdempotencyKey.expires_at <= now,
+                    and_(IdempotencyKey.status == "pending", IdempotencyKey.created_at < stale))
+            ).values(**values)
+            if conn.execute(stmt).rowcount == 1:
+                return "claimed", None
+        return "pending", None
+
+    def replay(self, key, stored, digest):
+        status_code, body, message_uuid, request_hash = stored
+        if request_hash != digest:
+            raise UnprocessableEntity("Idempotency-Key has been used by a different request.")
+        logger.info(f"Idempotency-Key {key} hit, return the response of {message_uuid}.")
+        response = current_app.response_class(body, status=status_code, mimetype="application/json")
+        response.headers["Idempotent-Replayed"] = "true"
+        return response
+
+    def store(self, response):
+        key = g.get("idempotency_key")
+        if key is None:
+            return response
+        conf = current_app.config.get("idempotency") or {}
+        if response.status_code >= 500 or response.status_code == 429:
+            self.release()
+            return response
+
+        stored = (response.status_code, response.get_data(as_text=True), g.get("uuid"), g.get("idempotency_hash"))
+        self.cache.set(key, stored)
+        g.pop("idempotency_key")
+        if not spool.enabled:
+            try:
+                with db.engine.begin() as conn:
+                    conn.execute(update(IdempotencyKey).where(IdempotencyKey.key == key).values(
+                        status="done", status_code=stored[0], response=stored[1], uuid=stored[2]))
+            except SQLAlchemyError as e:
+                logger.error(f"Failed to store response of Idempotency-Key {key}. [{e}]")
+            self.purge(conf)
+        self.finish(key)
+        return response
+
+    def release(self, exc=None):
+        """请求未产生可保存的响应时释放认领，允许重试"""
+        key = g.pop("idempotency_key", None)
+        if key is None:
+            return
+        if not spool.enabled:
+            try:
+                with db.engine.begin() as conn:
+                    conn.execute(delete(IdempotencyKey).where(IdempotencyKey.key == key,
+                                                              IdempotencyKey.status == "pending"))
+            except SQLAlchemyError as e:
+                logger.error(f"Failed to release Idempotency-Key {key}. [{e}]")
+        self.finish(key)
+
+    def finish(self, key):
+        with self.lock:
+            event = self.inflight.pop(key, None)
+        if event is not None:
+            event.set()
+
+    def purge(self, conf):
+        """定期清理过期记录"""
+        if time.monotonic() - self.last_purge < conf.get("purge_interval", 600):
+            return
+        self.last_purge = time.monotonic()
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(delete(IdempotencyKey).where(IdempotencyKey.expires_at <= datetime.now()))
+        except SQLAlchemyError as e:
+            logger.error(f"Failed to purge idempotency keys. [{e}]")
+
+
+idempotency = Idempotency()
@@ -3,21 +3,91 @@ import smtplib
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 import logging
+import threading
+import time
 from pathlib import Path
 from abc import ABC, abstractmethod
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError as RequestsConnectionError
 from sqlalchemy import select
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric import padding
 from flask import render_template, current_app, abort
+from werkzeug.exceptions import HTTPException
 from messagebus import db
 from messagebus.models import Token
+from messagebus.codec import parse_response
+from messagebus.cache import LRUCache
+from messagebus.replica import read_scalars
+from messagebus.admission import admission
+
+try:
+    import httpx
+except ImportError:  # httpx 为可选依赖，仅用于http2
+    httpx = None
 
 # from messagebus import decrypt
 
 logger = logging.getLogger('MBus')
 
+# 模板渲染结果缓存，键包含正文哈希
+rendered = LRUCache(maxsize=1024)
+
+
+def client_credentials_token(session, key, tokenurl, client_id, client_secret, verify=True):
+    """获取client_credentials模式的access token，token表中未过期的记录直接复用
+
+    :param session: 用于请求token的HTTP会话
+    :param key: token表中的记录标识，通常为连接器的key
+    :return: access token
+    """
+    stmt = select(Token).where(Token.channel == key)
+    rows = read_scalars(stmt)
+    row = rows[0] if rows else None
+    if row and row.expired_at > datetime.now():
+        logger.debug("Token no need to update.")
+        return row.access_token
+
+    params = {"client_id": client_id,
+              "client_secret": client_secret,
+              "grant_type": "client_credentials"}
+    response = session.post(tokenurl, params=params, verify=verify)
+    response.raise_for_status()
+    resp = parse_response(response)
+    logger.debug(resp)
+
+    expired_at = datetime.now() + timedelta(seconds=resp.get("expires_in"))
+    token = Token(channel=key,
+                  access_token=resp.get("access_token"),
+                  token_type=resp.get("token_type"),
+                  refresh_token=None,
+                  expired_at=expired_at)
+    db.session.merge(token)
+    logger.debug("Token has been updated.")
+    return token.access_token
+
+
+def render_content(message):
+    """按消息类别渲染模板，无模板时直接使用正文
+
+    开启render_cache时，渲染结果按 (模板, 正文哈希, 标题, 发送者) 缓存；历史数据没有正文哈希，不使用缓存
+    """
+    template = f"{message.category}.j2"
+    if not Path(f"{current_app.template_folder}/{template}").exists():
+        return message.content
+    if not current_app.config.get("render_cache") or message.content_hash is None:
+        return render_template(template, message=message)
+
+    key = (template, message.content_hash, message.title, message.sender)
+    content = rendered.get(key)
+    if content is None:
+        content = render_template(template, message=message)
+        rendered.set(key, content)
+    return content
+
 
 class MessageBus:
     """ 消息总线
@@ -29,6 +99,29 @@ class MessageBus:
         self.connectors = []
         self.routing_rules = []
 
+    @classmethod
+    def from_config(cls, config):
+        """根据配置中inuse的渠道创建消息总线并注册连接器"""
+        mbus = cls()
+        channels = config.get("channels")
+        sharding = config.get("sharding") or {}
+        for channel in config["inuse"]:
+            accounts = []
+            # 渠道下的每个profile对应一个上游账号，weight为权重，enabled为false时不启用
+            for account, conf in channels[channel].items():
+                conf = dict(conf)
+                weight = conf.pop("weight", 1)
+                if not conf.pop("enabled", True) or weight <= 0:
+                    continue
+                conn = ConnectorFactory.get_connector(channel, **conf)
+                conn.account = account
+                accounts.append((conn, weight))
+            if len(accounts) == 1:
+                mbus.register_connector(accounts[0][0])
+            elif accounts:
+                mbus.register_connector(AccountPool(channel, accounts, **sharding))
+        return mbus
+
     def register_connector(self, connector):
         """注册一个新的连接器"""
         self.connectors.append(connector)
@@ -39,8 +132,13 @@ class MessageBus:
         if not connector:
             logger.error(f"Connector {conn} not found.")
             return
-        with connector as conn:
-            conn.send(message, recipients)
+        start = time.monotonic()
+        try:
+            with connector as conn:
+                conn.send(message, recipients)
+        finally:
+            # 失败、超时的发送同样计入延迟，上游挂起时才能触发max_latency
+            admission.observe(connector.name, time.monotonic() - start)
 
     def _apply_transformations(self, message, connector):
         """应用消息转换规则（如有必要）"""
@@ -57,6 +155,13 @@ class MessageBus:
 
 
 class Connector(ABC):
+    account = "default"
+
+    @property
+    def key(self):
+        """账号标识，default账号与渠道名相同"""
+        return self.name if self.account == "default" else f"{self.name}.{self.account}"
+
     @abstractmethod
     def connect(self):
         """连接到消息中间件或平台"""
@@ -80,6 +185,31 @@ class Connector(ABC):
         self.disconnect()
 
 
+class ConnectorFactory:
+    """ 连接器注册表
+        连接器类通过 register 按类型注册，配置中可用 type 指定类型，缺省时类型与渠道名相同
+    """
+    registry = dict()
+
+    @classmethod
+    def register(cls, kind):
+        def decorator(connector_cls):
+            cls.registry[kind] = connector_cls
+            return connector_cls
+        return decorator
+
+    @classmethod
+    def get_connector(cls, conn, *args, **kwargs):
+        kind = kwargs.pop("type", conn)
+        connector_cls = cls.registry.get(kind)
+        if connector_cls is None:
+            raise ValueError(f"Unknown connection type: {kind}")
+        connector = connector_cls(*args, **kwargs)
+        connector.name = conn
+        return connector
+
+
+@ConnectorFactory.register("email")
 class EmailConnector(Connector):
     def __init__(self, smtp, port, email, password):
         self.name = "email"
@@ -118,6 +248,7 @@ class EmailConnector(Connector):
         logger.debug("Disconnected from email server")
 
 
+@ConnectorFactory.register("monkeytalk")
 class MonkeyTalkConnector(Connector):
     """
     api/sys/users/my
@@ -152,26 +283,25 @@ class MonkeyTalkConnector(Connector):
         url = f"{self.baseurl}/oa/message/send"
         # receivers = self.recipient_filter(recipients)
         receivers = recipients
-        if Path(f"{current_app.template_folder}/{message.category}.j2").exists():
-            content = render_template(f"{message.category}.j2", message=message)
-        else:
-            content = message.content
+        content = render_content(message)
         response = self.session.post(url, json={'content': content,
                                                 'userLists': receivers})
         response.raise_for_status()
-        logger.info(response.json())
-        if response.json().get('code') == 200:
+        resp = parse_response(response)
+        logger.info(resp)
+        if resp.get('code') == 200:
             logger.info(f"Message has been sent to {receivers}")
         else:
-            logger.error(f"Server has failed for [{response.json().get("msg")}]")
-            abort(response.json().get("code"), response.json().get("msg"))
+            logger.error(f"Server has failed for [{resp.get('msg')}]")
+            abort(resp.get("code"), resp.get("msg"))
 
     def recipient_filter(self, users):
         url = f"{self.baseurl}/oa/getFollowers/16288"
         response = self.session.get(url)
         response.raise_for_status()
-        logger.debug(response.json())
-        followers = [follower["username"] for follower in response.json().get('data')]
+        resp = parse_response(response)
+        logger.debug(resp)
+        followers = [follower["username"] for follower in resp.get('data')]
 
         diff = list(set(users) - set(followers))
         if diff:
@@ -187,12 +317,13 @@ class MonkeyTalkConnector(Connector):
         response = self.session.post(url, json={'username': self.user, 'password': self.ciphertext},
                                      headers={'Client-Version': '1.4.4'})
         response.raise_for_status()
-        if response.json().get("code") == 200:
-            self.token = response.json().get('token')
+        resp = parse_response(response)
+        if resp.get("code") == 200:
+            self.token = resp.get('token')
             self.session.headers.update({"Authorization": self.token})
         else:
-            logger.error(f"ERROR! Get token failed. [{response.json().get("msg")}]")
-            abort(response.json().get("code"), response.json().get("msg"))
+            logger.error(f"ERROR! Get token failed. [{resp.get('msg')}]")
+            abort(resp.get("code"), resp.get("msg"))
 
     def disconnect(self):
         # 关闭连接
@@ -201,6 +332,7 @@ class MonkeyTalkConnector(Connector):
         logger.debug("Disconnected from MonkeyTalk server")
 
 
+@ConnectorFactory.register("bocwechat")
 class BocWeChat(Connector):
 
     def __init__(self, baseurl, tokenurl, cert, client_id, client_secret):
@@ -226,49 +358,24 @@ class BocWeChat(Connector):
         """
         # receivers = self.recipient_filter(recipients)
         receivers = recipients
-        if Path(f"{current_app.template_folder}/{message.category}.j2").exists():
-            content = render_template(f"{message.category}.j2", message=message)
-        else:
-            content = message.content
+        content = render_content(message)
         targets = [{"targetType": "individual", "targetId": tid} for tid in receivers]
         response = self.session.post(self.baseurl, json={'content': content,
                                                          'type': "text",
                                                          'targets': targets})
         response.raise_for_status()
-        logger.info(response.json())
-        if response.json().get('status') == 200:
+        resp = parse_response(response)
+        logger.info(resp)
+        if resp.get('status') == 200:
             logger.info(f"Message has been sent to {receivers}")
         else:
-            logger.error(f"Server has failed for [{response.json().get("data")}]")
-            abort(response.json().get("status"), response.json().get("data"))
+            logger.error(f"Server has failed for [{resp.get('data')}]")
+            abort(resp.get("status"), resp.get("data"))
 
     def refresh_token(self):
-        stmt = select(Token).where(Token.channel == self.name)
-        row = db.session.execute(stmt).scalar()
-        if row and row.expired_at > datetime.now():
-            access_token = row.access_token
-            logger.debug("Token no need to update.")
-        else:
-            params = {"client_id": self.client_id,
-                      "client_secret": self.client_secret,
-                      "grant_type": "client_credentials"}
-            print(self.cert)
-            print(self.cert is True)
-            response = self.session.post(self.tokenurl, params=params, verify=self.cert if self.cert else False)
-            response.raise_for_status()
-            resp = response.json()
-            logger.debug(resp)
-
-            expired_at = datetime.now() + timedelta(seconds=resp.get("expires_in"))
-            token_type = resp.get("token_type")
-            access_token = resp.get("access_token")
-            token = Token(channel=self.name,
-                          access_token=access_token,
-                          token_type=token_type,
-                          refresh_token=None,
-                          expired_at=expired_at)
-            db.session.merge(token)
-            logger.debug("Token has been updated.")
+        access_token = client_credentials_token(self.session, self.key, self.tokenurl,
+                                                self.client_id, self.client_secret,
+                                                verify=self.cert if self.cert else False)
         self.session.headers.update({"Authorization": f"Bearer {access_token}"})
 
     def disconnect(self):
@@ -277,25 +384,269 @@ class BocWeChat(Connector):
         logger.debug("Disconnected from BocWeChat server")
 
 
-class ConnectorFactory:
-    @staticmethod
-    def get_connector(conn, *args, **kwargs):
-        if conn == "email":
-            return EmailConnector(kwargs["smtp"],
-                                  kwargs["port"],
-                                  kwargs["email"],
-                                  kwargs["password"])
-        elif conn == "monkeytalk":
-            return MonkeyTalkConnector(kwargs["baseurl"],
-                                       kwargs["user"],
-                                       kwargs["password"],
-                                       kwargs["cert"])
-        elif conn == "bocwechat":
-            print(kwargs)
-            return BocWeChat(kwargs["baseurl"],
-                             kwargs["tokenurl"],
-                             kwargs["cert"],
-                             kwargs["client_id"],
-                             kwargs["client_secret"])
+@ConnectorFactory.register("webhook")
+class WebhookConnector(Connector):
+    """ 通用Webhook连接器
+        url、请求体模板均来自配置，请求体模板为Jinja2字符串，可使用message、content、recipients变量。
+        HTTP连接池按账号在进程内复用并保持长连接；接收者按batch_size分批，多批请求由该账号共享的线程池
+        （concurrency个线程）在连接池上并发发送，
+        开启http2且安装了httpx[http2]时在同一连接上多路复用。
+
+        auth支持：
+            bearer: {type: bearer, token: ...}
+            basic: {type: basic, username: ..., password: ...}
+            client_credentials: {type: client_credentials, tokenurl: ..., client_id: ..., client_secret: ...}
+        success形如 {field: code, value: 0}，未配置时只检查HTTP状态码
+    """
+    # 账号key -> ClientHandle
+    clients = dict()
+    lock = threading.Lock()
+
+    def __init__(self, url, payload, method="POST", headers=None, auth=None, success=None,
+                 batch_size=0, concurrency=4, pool_size=10, timeout=10, http2=False, verify=True):
+        self.name = "webhook"
+        self.url = url
+        self.payload = payload
+        self.method = method
+        self.headers = {"Content-Type": "application/json", **(headers or {})}
+        self.auth = auth or {}
+        self.success = success
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.http2 = http2
+        self.verify = verify
+        self.request_headers = None
+
+    def connect(self):
+        self.request_headers = dict(self.headers)
+        kind = self.auth.get("type")
+        if kind == "bearer":
+            self.request_headers["Authorization"] = f"Bearer {self.auth['token']}"
+        elif kind == "basic":
+            raw = f"{self.auth['username']}:{self.auth['password']}".encode("utf-8")
+            self.request_headers["Authorization"] = f"Basic {base64.b64encode(raw).decode('ascii')}"
+        elif kind == "client_credentials":
+            with Session() as session:
+                access_token = client_credentials_token(session, self.key, self.auth["tokenurl"],
+                                                        self.auth["client_id"], self.auth["client_secret"],
+                                                        verify=self.verify)
+            self.request_headers["Authorization"] = f"Bearer {access_token}"
+
+    def disconnect(self):
+        # 连接池跨请求复用，不在此关闭
+        self.request_headers = None
+
+    def acquire(self):
+        """获取本账号的长连接客户端及线程池，配置热加载后参数变化时重建，用完需调用release"""
+        config = (self.url, self.pool_size, self.timeout, self.http2, self.verify, self.concurrency)
+        with self.lock:
+            handle = self.clients.get(self.key)
+            if handle is None or handle.config != config:
+                if handle is not None:
+                    handle.retire()
+                executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix=f"MBus-{self.key}")
+                handle = self.clients[self.key] = ClientHandle(config, self.create_client(), executor)
+            handle.users += 1
+            return handle
+
+    def release(self, handle):
+        with self.lock:
+            handle.users -= 1
+            if handle.retired and handle.users == 0:
+                handle.close()
+
+    def create_client(self):
+        if self.http2:
+            try:
+                if httpx is None:
+                    raise ImportError("httpx")
+                limits = httpx.Limits(max_connections=self.pool_size,
+                                      max_keepalive_connections=self.pool_size)
+                return httpx.Client(http2=True, limits=limits, timeout=self.timeout, verify=self.verify)
+            except ImportError:
+                logger.warning(f"httpx[http2] is not installed, {self.key} falls back to HTTP/1.1.")
+        session = Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.verify = self.verify
+        return session
+
+    def send(self, message, recipients):
+        content = render_content(message)
+        template = compile_template(self.payload)
+        size = self.batch_size or len(recipients) or 1
+        bodies = [template.render(message=message, content=content, recipients=recipients[i:i + size])
+                  for i in range(0, max(len(recipients), 1), size)]
+
+        handle = self.acquire()
+        try:
+            if len(bodies) == 1:
+                results = [self.post(handle.client, bodies[0])]
+            else:
+                results = list(handle.executor.map(lambda body: self.post(handle.client, body), bodies))
+        finally:
+            self.release(handle)
+
+        for resp in results:
+            if self.success and resp.get(self.success["field"]) != self.success["value"]:
+                logger.error(f"Server has failed for [{resp}]")
+                abort(502, f"{self.name} has failed for [{resp}]")
+        logger.info(f"Message has been sent to {recipients} in {len(bodies)} request(s).")
+
+    def post(self, client, body):
+        if isinstance(client, Session):
+            response = client.request(self.method, self.url, data=body.encode("utf-8"),
+                                      headers=self.request_headers, timeout=self.timeout)
         else:
-            raise ValueError(f"Unknown connection type: {conn}")
+            response = client.request(self.method, self.url, content=body.encode("utf-8"),
+                                      headers=self.request_headers, timeout=self.timeout)
+        response.raise_for_status()
+        return parse_response(response) if response.content else {}
+
+
+class ClientHandle:
+    """ 账号共享的HTTP客户端及线程池
+        配置变化后被替换的句柄标记为retired，最后一个使用者释放时关闭
+    """
+
+    def __init__(self, config, client, executor):
+        self.config = config
+        self.client = client
+        self.executor = executor
+        self.users = 0
+        self.retired = False
+
+    def retire(self):
+        self.retired = True
+        if self.users == 0:
+            self.close()
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.client.close()
+        logger.debug("Retired webhook client has been closed.")
+
+templates = LRUCache(maxsize=256)
+
+
+def compile_template(source):
+    """编译并缓存配置中的请求体模板
+
+    请求体不是HTML，关闭自动转义，JSON值应使用tojson过滤器输出
+    """
+    template = templates.get(source)
+    if template is None:
+        template = current_app.jinja_env.overlay(autoescape=False).from_string(source)
+        templates.set(source, template)
+    return template
+
+
+class AccountState:
+    def __init__(self, weight):
+        self.weight = weight
+        self.current_weight = 0
+        self.inflight = 0
+        self.down_until = 0
+        self.failures = 0
+
+
+class AccountPool(Connector):
+    """ 同一渠道的多账号池
+        按加权轮询（weighted）或最少在途（least_loaded）选择账号发送，
+        账号被限流、上游5xx或连接失败后在cooldown秒内（有Retry-After时以其为准）不再优先选择，并切换到下一个账号重试；
+        其它错误（如上游拒绝该消息、读超时）直接抛出，不影响账号状态。
+        账号状态在进程内跨请求共享。
+    """
+    states = dict()
+    lock = threading.Lock()
+
+    def __init__(self, name, accounts, strategy="weighted", cooldown=30):
+        self.name = name
+        self.accounts = accounts
+        self.strategy = strategy
+        self.cooldown = cooldown
+
+    def connect(self):
+        # 各账号在被选中时才建立连接
+        pass
+
+    def disconnect(self):
+        pass
+
+    def send(self, message, recipients):
+        last_error = None
+        for conn, state in self.candidates():
+            with self.lock:
+                state.inflight += 1
+            try:
+                with conn:
+                    conn.send(message, recipients)
+            except Exception as e:
+                # 上游可能已收到消息的错误不切换账号，避免重复发送
+                if not is_failover_error(e):
+                    raise
+                self.mark_down(conn, state, e)
+                last_error = e
+                continue
+            finally:
+                with self.lock:
+                    state.inflight -= 1
+            with self.lock:
+                state.failures = 0
+                state.down_until = 0
+            logger.debug(f"Message has been sent by account {conn.key}.")
+            return
+        raise last_error
+
+    def candidates(self):
+        """按策略给出本次尝试的账号顺序，全部在冷却时只尝试最早恢复的账号，避免放大上游限流"""
+        now = time.monotonic()
+        with self.lock:
+            pairs = []
+            for conn, weight in self.accounts:
+                state = self.states.setdefault(conn.key, AccountState(weight))
+                state.weight = weight
+                pairs.append((conn, state))
+            healthy = [pair for pair in pairs if pair[1].down_until <= now]
+            if not healthy:
+                return [min(pairs, key=lambda pair: pair[1].down_until)]
+
+            if self.strategy == "least_loaded":
+                return sorted(healthy, key=lambda pair: pair[1].inflight / pair[1].weight)
+
+            # 平滑加权轮询
+            total = 0
+            for _, state in healthy:
+                state.current_weight += state.weight
+                total += state.weight
+            best = max(healthy, key=lambda pair: pair[1].current_weight)
+            best[1].current_weight -= total
+            others = sorted((pair for pair in healthy if pair is not best),
+                            key=lambda pair: pair[1].weight, reverse=True)
+            return [best] + others
+
+    def mark_down(self, conn, state, error):
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        cooldown = int(retry_after) if retry_after and retry_after.isdigit() else self.cooldown
+        with self.lock:
+            state.failures += 1
+            state.down_until = time.monotonic() + cooldown
+        logger.warning(f"Account {conn.key} failed for [{error}], cooling down {cooldown}s and failing over.")
+
+
+def is_failover_error(error):
+    """账号被限流（429）、上游5xx或连接建立失败时才切换账号"""
+    if isinstance(error, HTTPException):
+        # 上游在响应体中报告限流
+        return error.code == 429
+    if isinstance(error, (RequestsConnectionError, ConnectionRefusedError, smtplib.SMTPConnectError)):
+        return True
+    if httpx is not None and isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)):
+        return True
+    response = getattr(error, "response", None)
+    status_code = getattr(response, "status_code", None)
+    return status_code is not None and (status_code == 429 or status_code >= 500)
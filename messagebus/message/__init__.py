@@ -1,11 +1,14 @@
 from flask import Blueprint, g
 from .message import MessageView
+from .history import MessageHistoryView
 
 
 message_bp = Blueprint('message', __name__)
 
 # 实例化 MessageView 类
 message_view = MessageView.as_view('message_view')
+history_view = MessageHistoryView.as_view('history_view')
 
 # 注册视图函数到蓝图
-message_bp.add_url_rule('/message', view_func=message_view, methods=['POST'])
\ No newline at end of file
+message_bp.add_url_rule('/message', view_func=message_view, methods=['POST'])
+message_bp.add_url_rule('/messages', view_func=history_view, methods=['GET'])
\ No newline at end of file
@@ -0,0 +1,131 @@
+from flask import jsonify, request, Response, stream_with_context
+from flask.views import MethodView
+from sqlalchemy import select, and_, or_
+from messagebus.models import Message, MessageSchema, DeliveryLog, DeliveryLogSchema
+from messagebus.codec import get_schema, dumps
+from messagebus.replica import run_read
+from werkzeug.exceptions import BadRequest
+from datetime import datetime
+import base64
+import json
+import logging
+
+logger = logging.getLogger('MBus')
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+STREAM_BATCH = 500
+
+
+class MessageHistoryView(MethodView):
+    """ 消息历史及状态查询
+        按 (created_at, id) 倒序做键集分页，支持以 NDJSON 流式导出大结果集
+    """
+
+    def get(self):
+        args = request.args
+        stmt = select(Message)
+        for field in ("sender", "category", "status"):
+            if args.get(field):
+                stmt = stmt.where(getattr(Message, field) == args.get(field))
+        if args.get("start"):
+            stmt = stmt.where(Message.created_at >= parse_time(args.get("start")))
+        if args.get("end"):
+            stmt = stmt.where(Message.created_at < parse_time(args.get("end")))
+        if args.get("cursor"):
+            created_at, last_id = decode_cursor(args.get("cursor"))
+            stmt = stmt.where(or_(Message.created_at < created_at,
+                                  and_(Message.created_at == created_at, Message.id < last_id)))
+        stmt = stmt.order_by(Message.created_at.desc(), Message.id.desc())
+        detail = args.get("detail", "false").lower() in ("1", "true", "yes")
+
+        if args.get("format") == "ndjson" or request.accept_mimetypes.best == "application/x-ndjson":
+            limit = parse_limit(args.get("limit")) if args.get("limit") else None
+            return Response(stream_with_context(self.stream(stmt, limit, detail)),
+                            mimetype="application/x-ndjson")
+
+        limit = parse_limit(args.get("limit", DEFAULT_LIMIT))
+        data, keys = fetch(stmt, limit + 1, detail)
+        next_cursor = None
+        if len(data) > limit:
+            data = data[:limit]
+            next_cursor = encode_cursor(*keys[limit - 1])
+
+        return jsonify({"data": data,
+                        "next_cursor": next_cursor,
+                        "code": "ok"}), 200
+
+    @staticmethod
+    def stream(stmt, limit, detail):
+        """按键集分批读取，逐批输出，内存占用与驱动是否支持服务端游标无关"""
+        while limit is None or limit > 0:
+            size = STREAM_BATCH if limit is None else min(STREAM_BATCH, limit)
+            data, keys = fetch(stmt, size, detail)
+            if not data:
+                return
+            yield "".join(dumps(item) + "\n" for item in data)
+
+            if len(data) < size:
+                return
+            if limit is not None:
+                limit -= len(data)
+            created_at, last_id = keys[-1]
+            stmt = stmt.where(or_(Message.created_at < created_at,
+                                  and_(Message.created_at == created_at, Message.id < last_id)))
+
+
+def fetch(stmt, size, detail):
+    """读取一批消息，返回序列化结果及各条的 (created_at, id)
+
+    每批使用独立的短会话，不在只读副本上保持长事务
+    """
+    def query(session):
+        messages = session.execute(stmt.limit(size)).scalars().all()
+        data = get_schema(MessageSchema, many=True).dump(messages)
+        if detail:
+            attach_deliveries(session, data)
+        return data, [(message.created_at, message.id) for message in messages]
+
+    return run_read(query)
+
+def attach_deliveries(session, data):
+    """将 delivery_log 中的逐个接收者发送明细合并到消息上"""
+    uuids = [item["uuid"] for item in data]
+    deliveries = dict()
+    if uuids:
+        stmt = select(DeliveryLog).where(DeliveryLog.uuid.in_(uuids)).order_by(DeliveryLog.id)
+        schema = get_schema(DeliveryLogSchema)
+        for log in session.execute(stmt).scalars():
+            deliveries.setdefault(log.uuid, []).append(schema.dump(log))
+    for item in data:
+        item["deliveries"] = deliveries.get(item["uuid"], [])
+
+
+def encode_cursor(created_at, last_id):
+    raw = json.dumps([created_at.isoformat(), last_id])
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    try:
+        created_at, last_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return datetime.fromisoformat(created_at), int(last_id)
+    except (ValueError, TypeError):
+        raise BadRequest(f"Invalid cursor {cursor}")
+
+
+def parse_time(value):
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise BadRequest(f"Invalid time {value}, expected format like 2024-01-01 09:00:00")
+
+
+def parse_limit(value):
+    try:
+        limit = int(value)
+    except (ValueError, TypeError):
+        raise BadRequest(f"Invalid limit {value}")
+    if not 0 < limit <= MAX_LIMIT:
+        raise BadRequest(f"limit should be between 1 and {MAX_LIMIT}")
+    return limit
@@ -1,12 +1,18 @@
 from flask import jsonify, g, request
 from flask.views import MethodView
 from sqlalchemy import select, update
-from messagebus.models import Subscription, MessageSchema, Recipient, Message
+from sqlalchemy.orm import selectinload
+from messagebus.models import Subscription, MessageSchema, Recipient, Message, Schedule
 from messagebus import db
+from messagebus.codec import get_schema, dumps
+from messagebus.scheduler import scheduler
+from messagebus.replica import read_scalars
+from messagebus.spool import spool
 import logging
 from werkzeug.exceptions import BadRequest, UnprocessableEntity
 from croniter import croniter
-from datetime import datetime
+from marshmallow import ValidationError
+from datetime import datetime, timedelta
 
 logger = logging.getLogger('MBus')
 
@@ -20,92 +26,188 @@ class MessageView(MethodView):
             logger.error("The request has no data provided!")
             raise BadRequest("No data provided")
 
-        schema = MessageSchema()
+        if spool.enabled:
+            return accept_message(data)
+
+        return handle_message(data)
+
+
+def accept_message(data):
+    """校验后写入本地缓冲即返回，由回放线程完成入库与投递"""
+    payload = data.get("Message")
+    if not isinstance(payload, dict):
+        raise BadRequest("No message provided")
+    errors = get_schema(MessageSchema).validate(dict(payload))
+    if errors:
+        raise BadRequest(f"Invalid message {errors}")
+    if (payload.get("send_at") is not None or payload.get("delay") is not None) and not scheduler.accepting():
+        raise UnprocessableEntity("Scheduled delivery is disabled, send_at and delay are not accepted.")
+
+    # 创建时间与延时以接收时刻为准
+    now = datetime.now()
+    payload = dict(payload)
+    payload.setdefault("created_at", now.strftime("%Y-%m-%d %H:%M:%S"))
+    if payload.get("delay"):
+        # 校验通过的delay可能是数字字符串
+        delay = int(payload.pop("delay"))
+        payload["send_at"] = (now + timedelta(seconds=delay)).strftime("%Y-%m-%d %H:%M:%S")
+
+    spool.append({"uuid": g.uuid, "data": dict(data, Message=payload)})
+    logger.info(f"【{payload.get('title')}】 from {payload.get('sender')} has been spooled.")
+    return jsonify({"message": f"Message {g.uuid} has been accepted.",
+                    "code": "accepted"}), 202
+
+
+def handle_message(data):
+    """消息入库、路由并投递，返回响应"""
+    schema = get_schema(MessageSchema)
+    try:
         message = schema.load(data.get('Message'))
-        extra = data.get("extra")
-        recipients_in_channel = dict()
-        message.uuid = g.uuid
-        message.status = "created"
+    except ValidationError as e:
+        raise BadRequest(f"Invalid message {e.messages}")
+    extra = data.get("extra")
+    message.uuid = g.uuid
+    message.status = "created"
+    if message.send_at is not None and not scheduler.accepting():
+        raise UnprocessableEntity("Scheduled delivery is disabled, send_at and delay are not accepted.")
+
+    # 定时/延时发送的消息只登记计划，到期后由调度器投递
+    if message.send_at and message.send_at > datetime.now():
+        message.status = "scheduled"
         db.session.add(message)
+        db.session.add(Schedule(uuid=message.uuid,
+                                due_at=message.send_at,
+                                extra=dumps(extra) if extra else None,
+                                status="pending"))
         db.session.commit()
-        logger.info(f"【{message.title}】 from {message.sender} has been created.")
+        scheduler.notify(message.send_at)
+        logger.info(f"【{message.title}】 from {message.sender} has been scheduled at {message.send_at}.")
+        return jsonify({"message": f"Message {message.uuid} has been scheduled at {message.send_at}.",
+                        "code": "scheduled"}), 200
 
-        stmt = select(Subscription).where((Subscription.sender == message.sender)
-                                          &
-                                          (Subscription.category == message.category)
-                                          &
-                                          Subscription.is_active.is_(True))
-        subscriptions = db.session.execute(stmt).scalars().all()
+    db.session.add(message)
+    db.session.commit()
+    logger.info(f"【{message.title}】 from {message.sender} has been created.")
 
-        if not subscriptions:
-            logger.info(f"{message.sender} with {message.category} has no subscription.")
-            if extra:
-                recipients_in_channel = extra
-            else:
-                raise UnprocessableEntity(f"{message.sender} with {message.category} has no recipient.")
+    recipients_in_channel = resolve_recipients(message, extra)
+    channel = dispatch(g.mbus, message, recipients_in_channel)
+    if channel:
+        return jsonify({"message": f"Message {message.uuid} has no recipient in {channel}.",
+                        "code": "warning"}), 200
+
+    return jsonify({"message": f"Message {message.uuid} has been sent.",
+                    "code": "ok"}), 200
+
+
+def resume_message(data):
+    """回放时消息已入库：状态仍为created说明入库后路由或投递被中断，继续投递
+
+    :return: 是否继续投递了该消息
+    """
+    message = db.session.execute(select(Message).where(Message.uuid == g.uuid)).scalar()
+    if message is None or message.status != "created":
+        return False
+
+    recipients_in_channel = resolve_recipients(message, data.get("extra"))
+    channel = dispatch(g.mbus, message, recipients_in_channel)
+    if channel:
+        logger.warning(f"Message {message.uuid} has no recipient in {channel}.")
+    return True
+
+
+def resolve_recipients(message, extra):
+    """
+    根据订阅关系及extra计算各渠道的接收者
+
+    :param message: 消息对象
+    :param extra: 请求中额外指定的各渠道接收者
+    :return: 渠道到接收者列表的字典
+    """
+    recipients_in_channel = dict()
+    stmt = select(Subscription).where((Subscription.sender == message.sender)
+                                      &
+                                      (Subscription.category == message.category)
+                                      &
+                                      Subscription.is_active.is_(True))
+    subscriptions = read_scalars(stmt)
+
+    if not subscriptions:
+        logger.info(f"{message.sender} with {message.category} has no subscription.")
+        if extra:
+            recipients_in_channel = extra
         else:
-            wishlist = dict()
-            for subscription in subscriptions:
-                if not is_time_in_crontab(subscription.cronexpress):
-                    logger.info(f"【{message.title}】 "
-                                f"from {message.sender} "
-                                f"has been filtered by {subscription.recipient}")
-                    continue
-                wishlist.setdefault(subscription.channel, []).append(subscription.recipient)
-
-            # 获取各发送渠道所对应的所有订阅者
-            for channel, recipients in wishlist.items():
-                stmt = select(Recipient).where(Recipient.id.in_(recipients))
-                receivers = db.session.execute(stmt).scalars().all()
-                for receiver in receivers:
-                    if receiver.is_group:
-                        for member in receiver.members:
-                            if member.active:
-                                recipients.append(member.recipient)
-                recipients = list(set(wishlist[channel]))
-
-                # 获取各channel的订阅者的对应的接收信息
-                stmt = select(Recipient).where(Recipient.id.in_(recipients))
-                receivers = db.session.execute(stmt).scalars().all()
-                for receiver in receivers:
-                    if not receiver.is_group:
-                        if getattr(receiver, channel) is None:
-                            logger.error(f"{receiver.name} has invalid {channel} channel.")
-                            continue
-                        recipients_in_channel.setdefault(channel, []).append(getattr(receiver, channel))
-
-            # 合并发送人员
-            if recipients_in_channel:
-                if extra:
-                    for channel, recipients in extra.items():
-                        if channel in recipients_in_channel:
-                            recipients_in_channel[channel].extend(recipients)
-                        else:
-                            recipients_in_channel[channel] = recipients
-            else:
-                recipients_in_channel = extra
-
-        if not recipients_in_channel:
             raise UnprocessableEntity(f"{message.sender} with {message.category} has no recipient.")
+    else:
+        wishlist = dict()
+        for subscription in subscriptions:
+            if not is_time_in_crontab(subscription.cronexpress):
+                logger.info(f"【{message.title}】 "
+                            f"from {message.sender} "
+                            f"has been filtered by {subscription.recipient}")
+                continue
+            wishlist.setdefault(subscription.channel, []).append(subscription.recipient)
+
+        # 获取各发送渠道所对应的所有订阅者
+        for channel, recipients in wishlist.items():
+            stmt = select(Recipient).where(Recipient.id.in_(recipients)).options(selectinload(Recipient.members))
+            receivers = read_scalars(stmt)
+            for receiver in receivers:
+                if receiver.is_group:
+                    for member in receiver.members:
+                        if member.active:
+                            recipients.append(member.recipient)
+            recipients = list(set(wishlist[channel]))
+
+            # 获取各channel的订阅者的对应的接收信息
+            stmt = select(Recipient).where(Recipient.id.in_(recipients))
+            receivers = read_scalars(stmt)
+            for receiver in receivers:
+                if not receiver.is_group:
+                    if getattr(receiver, channel) is None:
+                        logger.error(f"{receiver.name} has invalid {channel} channel.")
+                        continue
+                    recipients_in_channel.setdefault(channel, []).append(getattr(receiver, channel))
+
+        # 合并发送人员
+        if recipients_in_channel:
+            if extra:
+                for channel, recipients in extra.items():
+                    if channel in recipients_in_channel:
+                        recipients_in_channel[channel].extend(recipients)
+                    else:
+                        recipients_in_channel[channel] = recipients
+        else:
+            recipients_in_channel = extra
 
-        for channel, recipients in recipients_in_channel.items():
-            if recipients:
-                g.mbus.send(channel, message, recipients)
-            else:
-                return jsonify({"message": f"Message {message.uuid} has no recipient in {channel}.",
-                                "code": "warning"}), 200
-
-        stmt = update(Message).where(
-            Message.uuid == message.uuid
-        ).values(
-            sent_at=datetime.now(),
-            status="completed"
-        )
-        db.session.execute(stmt)
-        db.session.commit()
+    if not recipients_in_channel:
+        raise UnprocessableEntity(f"{message.sender} with {message.category} has no recipient.")
+
+    return recipients_in_channel
 
-        return jsonify({"message": f"Message {message.uuid} has been sent.",
-                        "code": "ok"}), 200
+
+def dispatch(mbus, message, recipients_in_channel):
+    """
+    通过消息总线向各渠道发送消息，全部发送后将消息置为completed
+
+    :param mbus: 消息总线
+    :param message: 消息对象
+    :param recipients_in_channel: 渠道到接收者列表的字典
+    :return: 存在无接收者的渠道时返回该渠道名，否则返回None
+    """
+    for channel, recipients in recipients_in_channel.items():
+        if recipients:
+            mbus.send(channel, message, recipients)
+        else:
+            return channel
+
+    stmt = update(Message).where(
+        Message.uuid == message.uuid
+    ).values(
+        sent_at=datetime.now(),
+        status="completed"
+    )
+    db.session.execute(stmt)
+    db.session.commit()
 
 
 def is_time_in_crontab(cron_expression):
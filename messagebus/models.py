@@ -1,12 +1,16 @@
 from sqlalchemy import (String, Integer, Text, DateTime,
                         UniqueConstraint, PrimaryKeyConstraint,
-                        Index, ForeignKey, Boolean)
-from sqlalchemy.orm import Mapped, mapped_column, relationship
-from marshmallow import Schema, fields, post_load, pre_load
-from datetime import datetime, timezone
+                        Index, ForeignKey, Boolean, LargeBinary, Double, select, insert, event)
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Mapped, mapped_column, relationship, Session
+from marshmallow import Schema, fields, post_load, pre_load, validate, validates_schema, ValidationError
+from datetime import datetime, timezone, timedelta
 from messagebus import db
+from messagebus.cache import LRUCache
 from typing import Optional
 from flask import g
+from hashlib import sha256
+import zlib
 
 
 class Subscription(db.Model):
@@ -51,21 +55,96 @@ class SubscriptionSchema(Schema):
         return data
 
 
+class MessageBody(db.Model):
+    __tablename__ = 'message_body'  # 按内容哈希去重存储的消息正文
+
+    hash: Mapped[str] = mapped_column(String(64), primary_key=True, comment="正文sha256")
+    data: Mapped[bytes] = mapped_column(LargeBinary(16777215), nullable=False, comment="zlib压缩后的正文")
+    size: Mapped[int] = mapped_column(Integer, nullable=False, comment="正文原始字节数")
+    created_at: Mapped[datetime] = mapped_column(DateTime,
+                                                 default=datetime.now,
+                                                 comment="创建时间")
+
+    # 已确认落库的正文哈希，命中时无需再查询数据库
+    known = LRUCache(maxsize=10000)
+
+    @property
+    def text(self):
+        return zlib.decompress(self.data).decode("utf-8")
+
+    @classmethod
+    def intern(cls, conn, digest, text):
+        """在当前事务中保存正文，已存在则复用"""
+        if digest in cls.known:
+            return
+
+        stmt = select(cls.hash).where(cls.hash == digest)
+        if conn.execute(stmt).scalar() is not None:
+            cls.known.set(digest, True)
+            return
+
+        raw = text.encode("utf-8")
+        try:
+            with conn.begin_nested():
+                conn.execute(insert(cls).values(hash=digest, data=zlib.compress(raw),
+                                                size=len(raw), created_at=datetime.now()))
+        except IntegrityError:
+            # 并发请求已写入相同正文
+            pass
+
+
 class Message(db.Model):
     __tablename__ = 'message'  # 消息表
 
     id: Mapped[int] = mapped_column(Integer, autoincrement=True, primary_key=True, comment="消息ID")
-    content: Mapped[str] = mapped_column(Text, comment="消息内容")
+    # 正文存放在 message_body 中，content 列仅保留历史数据
+    legacy_content: Mapped[Optional[str]] = mapped_column("content", Text, nullable=True, comment="消息内容（历史数据）")
+    content_hash: Mapped[Optional[str]] = mapped_column(ForeignKey("message_body.hash"),
+                                                        nullable=True, comment="消息正文哈希")
+    body: Mapped[Optional[MessageBody]] = relationship(lazy="joined")
     title: Mapped[str] = mapped_column(String(150), nullable=False, comment="消息标题")
     category: Mapped[str] = mapped_column(String(150), nullable=False, comment="消息类别")
     created_at: Mapped[datetime] = mapped_column(DateTime,
-                                                 default=datetime.now(),
+                                                 default=datetime.now,
                                                  comment="创建时间")
     sent_at: Mapped[datetime] = mapped_column(nullable=True, comment="发送时间")
+    send_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True, comment="计划发送时间")
     sender: Mapped[str] = mapped_column(String(50), nullable=False, comment="发送者")
     status: Mapped[str] = mapped_column(String(32), nullable=False, comment="消息状态")
     uuid: Mapped[str] = mapped_column(String(36), unique=True, nullable=False, comment="消息唯一uuid标识")
 
+    # 支撑按 (created_at, id) 的键集分页查询
+    __table_args__ = (
+        Index("ix_message_created", "created_at", "id"),
+        Index("ix_message_sender_created", "sender", "created_at", "id"),
+        Index("ix_message_category_created", "category", "created_at", "id"),
+        Index("ix_message_status_created", "status", "created_at", "id"),
+        Index("ix_message_content_hash", "content_hash"),
+    )
+
+    @property
+    def content(self):
+        content = getattr(self, "_content", None)
+        if content is None:
+            content = self.body.text if self.body is not None else self.legacy_content
+            self._content = content
+        return content
+
+    @content.setter
+    def content(self, value):
+        # 只计算哈希，正文在flush前由 intern_message_bodies 写入
+        self._content = self._pending_body = value
+        self.content_hash = sha256(value.encode("utf-8")).hexdigest() if value is not None else None
+
+
+@event.listens_for(Session, "before_flush")
+def intern_message_bodies(session, flush_context, instances):
+    """消息写库前保存其正文，保证 content_hash 引用的 message_body 记录存在"""
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, Message) and getattr(obj, "_pending_body", None) is not None:
+            MessageBody.intern(session.connection(), obj.content_hash, obj._pending_body)
+            obj._pending_body = None
+
 
 class MessageSchema(Schema):
     id = fields.Integer(dump_only=True)
@@ -74,12 +153,22 @@ class MessageSchema(Schema):
     category = fields.String(allow_none=False, required=True)
     created_at = fields.DateTime(required=False, format="%Y-%m-%d %H:%M:%S")
     sent_at = fields.DateTime(allow_none=True, format="%Y-%m-%d %H:%M:%S")
+    send_at = fields.DateTime(allow_none=True, format="%Y-%m-%d %H:%M:%S")
+    delay = fields.Integer(load_only=True, validate=validate.Range(min=0))
     sender = fields.String(allow_none=False)
     status = fields.String(required=False)
     uuid = fields.String(required=False)
 
+    @validates_schema
+    def check_send_at(self, data, **kwargs):
+        if data.get("send_at") is not None and data.get("delay") is not None:
+            raise ValidationError("send_at and delay are mutually exclusive.", "delay")
+
     @post_load
     def make_message(self, data, **kwargs):
+        delay = data.pop("delay", None)
+        if delay:
+            data["send_at"] = datetime.now() + timedelta(seconds=delay)
         return Message(**data)
 
     @pre_load
@@ -93,6 +182,22 @@ class MessageSchema(Schema):
         return data
 
 
+class Schedule(db.Model):
+    __tablename__ = "schedule"  # 定时发送计划表
+
+    id: Mapped[int] = mapped_column(Integer, autoincrement=True, primary_key=True)
+    uuid: Mapped[str] = mapped_column(String(36), unique=True, nullable=False, comment="消息唯一uuid标识")
+    due_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, comment="到期时间")
+    extra: Mapped[Optional[str]] = mapped_column(Text, nullable=True, comment="请求中的extra接收者，JSON")
+    status: Mapped[str] = mapped_column(String(32), nullable=False, comment="pending/queued/completed/failed")
+    owner: Mapped[Optional[str]] = mapped_column(String(64), nullable=True, comment="认领该计划的调度器")
+    claimed_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True, comment="认领时间")
+
+    __table_args__ = (
+        Index("ix_schedule_status_due", "status", "due_at"),
+    )
+
+
 class Recipient(db.Model):
     __tablename__ = "recipient"
 
@@ -168,6 +273,10 @@ class DeliveryLog(db.Model):
                                                  default=datetime.now(),
                                                  comment="更新时间")
 
+    __table_args__ = (
+        Index("ix_delivery_log_uuid", "uuid"),
+    )
+
 
 class DeliveryLogSchema(Schema):
     id = fields.Integer(dump_only=True)
@@ -175,6 +284,7 @@ class DeliveryLogSchema(Schema):
     task_id = fields.String(required=True, allow_none=False)
     recipient = fields.String(required=True, allow_none=False)
     employee_id = fields.String(allow_none=True)
+    channel = fields.String(allow_none=True)
     status = fields.String(required=True, allow_none=False)
     updated_at = fields.DateTime(allow_none=True, format="%Y-%m-%d %H:%M:%S")
 
@@ -203,3 +313,28 @@ class TokenSchema(Schema):
     @post_load
     def make_token(self, data, **kwargs):
         return Token(**data)
+
+
+class RateBucket(db.Model):
+    __tablename__ = 'rate_bucket'  # 准入控制令牌桶
+
+    key: Mapped[str] = mapped_column(String(200), primary_key=True, comment="限流键，global或sender:<发送者>")
+    tokens: Mapped[float] = mapped_column(Double, nullable=False, comment="剩余令牌数")
+    updated_at: Mapped[float] = mapped_column(Double, nullable=False, comment="最后更新时间戳（秒）")
+
+
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotency_key'  # 幂等请求的响应缓存
+
+    key: Mapped[str] = mapped_column(String(200), primary_key=True, comment="<发送者>:<请求头Idempotency-Key>")
+    uuid: Mapped[Optional[str]] = mapped_column(String(36), nullable=True, comment="首个请求的消息uuid")
+    status: Mapped[str] = mapped_column(String(32), nullable=False, comment="pending/done")
+    status_code: Mapped[Optional[int]] = mapped_column(Integer, nullable=True, comment="响应状态码")
+    response: Mapped[Optional[str]] = mapped_column(Text, nullable=True, comment="响应内容")
+    request_hash: Mapped[Optional[str]] = mapped_column(String(64), nullable=True, comment="请求体sha256")
+    created_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, comment="创建时间")
+    expires_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, comment="过期时间")
+
+    __table_args__ = (
+        Index("ix_idempotency_key_expires", "expires_at"),
+    )
@@ -0,0 +1,131 @@
+import cProfile
+import logging
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from flask import g, request, current_app
+
+logger = logging.getLogger('MBus')
+
+
+class StackSampler(threading.Thread):
+    """ 调用栈采样器
+        按固定间隔采样目标线程的调用栈，折叠为 flamegraph 可用的 "a;b;c" 形式
+    """
+
+    def __init__(self, thread_id, interval):
+        super().__init__(name="MBusStackSampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[collapse(frame)] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        return self.stacks
+
+
+def collapse(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+class Profiler:
+    """ 请求级按需性能剖析
+        由 messagebus.yaml 中的 profiling 配置控制，每个请求读取一次配置，支持热加载。
+        关闭时仅有一次配置查询的开销。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # cProfile 同一时刻只能有一个实例处于激活状态
+        self.cprofile_lock = threading.Lock()
+        self.stacks = Counter()
+        self.stats = None
+        self.last_flush = time.monotonic()
+
+    def init_app(self, app):
+        app.before_request(self.start)
+        app.teardown_request(self.stop)
+
+    def selected(self, conf):
+        if request.endpoint not in conf.get("endpoints", ["message.message_view"]):
+            return False
+        if request.headers.get("X-Request-ID") in conf.get("request_ids", []):
+            return True
+        return random.random() < conf.get("sample_rate", 0)
+
+    def start(self):
+        conf = current_app.config.get("profiling")
+        if not conf or not conf.get("enabled") or not self.selected(conf):
+            return
+
+        if conf.get("mode", "stack") == "cprofile":
+            if not self.cprofile_lock.acquire(blocking=False):
+                return
+            profile = cProfile.Profile()
+            profile.enable()
+            g.profile = profile
+        else:
+            sampler = StackSampler(threading.get_ident(), conf.get("interval", 0.005))
+            sampler.start()
+            g.profile = sampler
+
+    def stop(self, exc=None):
+        profile = g.pop("profile", None)
+        if profile is None:
+            return
+        conf = current_app.config.get("profiling") or {}
+
+        if isinstance(profile, StackSampler):
+            stacks = profile.stop()
+            with self.lock:
+                self.stacks.update(stacks)
+            logger.info(f"Request profiled with {sum(stacks.values())} stack samples.")
+        else:
+            profile.disable()
+            self.cprofile_lock.release()
+            with self.lock:
+                if self.stats is None:
+                    self.stats = pstats.Stats(profile)
+                else:
+                    self.stats.add(profile)
+            logger.info("Request profiled with cProfile.")
+
+        if time.monotonic() - self.last_flush >= conf.get("flush_interval", 10):
+            self.flush(conf.get("output", "profiles"))
+
+    def flush(self, output):
+        """写出聚合结果：stacks-<pid>.folded 可直接交给 flamegraph.pl/speedscope，cprofile-<pid>.prof 供 pstats 使用"""
+        with self.lock:
+            if not self.stacks and self.stats is None:
+                return
+            os.makedirs(output, exist_ok=True)
+            self.last_flush = time.monotonic()
+            if self.stacks:
+                path = os.path.join(output, f"stacks-{os.getpid()}.folded")
+                with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+                    for stack, count in self.stacks.items():
+                        f.write(f"{stack} {count}\n")
+                os.replace(f"{path}.tmp", path)
+            if self.stats is not None:
+                self.stats.dump_stats(os.path.join(output, f"cprofile-{os.getpid()}.prof"))
+        logger.debug(f"Profiling data has been written to {output}.")
+
+
+profiler = Profiler()
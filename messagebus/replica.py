@@ -0,0 +1,134 @@
+import itertools
+import logging
+import threading
+import time
+from flask import current_app
+from sqlalchemy.exc import DBAPIError, OperationalError, SQLAlchemyError
+from sqlalchemy.orm import Session
+from messagebus import db
+
+logger = logging.getLogger('MBus')
+
+# MySQL错误码：语法错误、缺少权限
+ER_PARSE_ERROR = 1064
+ER_SPECIFIC_ACCESS_DENIED_ERROR = 1227
+
+
+class ReplicaRouter:
+    """ 只读查询路由
+        在 read_replicas.binds 配置的只读副本间轮询，复制延迟超过 max_lag 或连接失败的副本
+        在 check_interval 秒内不再使用，无可用副本时回退主库
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+        self.status = dict()
+
+    def pick(self):
+        """选择一个可用副本的engine，没有可用副本时返回None"""
+        conf = current_app.config.get("read_replicas") or {}
+        binds = conf.get("binds") or []
+        for _ in range(len(binds)):
+            bind = binds[next(self.counter) % len(binds)]
+            if self.healthy(bind, conf):
+                return db.engines[bind]
+        return None
+
+    def healthy(self, bind, conf):
+        now = time.monotonic()
+        with self.lock:
+            status = self.status.get(bind)
+            if status and now - status[1] < conf.get("check_interval", 10):
+                return status[0]
+
+        max_lag = conf.get("max_lag", 5)
+        try:
+            lag = replica_lag(db.engines[bind]) if max_lag is not None else 0
+            healthy = lag is not None and lag <= max_lag
+            if not healthy:
+                logger.warning(f"Replica {bind} lags {lag}s behind, fall back to primary.")
+        except SQLAlchemyError as e:
+            if mysql_errno(e) == ER_SPECIFIC_ACCESS_DENIED_ERROR:
+                logger.error(f"Replica {bind} lag check requires the REPLICATION CLIENT privilege "
+                             f"(GRANT REPLICATION CLIENT ON *.* TO <user>), or set read_replicas.max_lag "
+                             f"to null to skip it. [{e}]")
+            else:
+                logger.error(f"Replica {bind} is unavailable. [{e}]")
+            healthy = False
+
+        with self.lock:
+            self.status[bind] = (healthy, now)
+        return healthy
+
+    def mark_down(self, engine):
+        with self.lock:
+            for bind, status in self.status.items():
+                if db.engines.get(bind) is engine:
+                    self.status[bind] = (False, time.monotonic())
+
+
+def mysql_errno(error):
+    """取出驱动异常中的MySQL错误码"""
+    if not isinstance(error, DBAPIError) or error.orig is None:
+        return None
+    errno = getattr(error.orig, "errno", None)
+    if errno is None and error.orig.args and isinstance(error.orig.args[0], int):
+        errno = error.orig.args[0]
+    return errno
+
+
+def replica_lag(engine):
+    """查询复制延迟（秒），复制中断时返回None；非MySQL或非副本实例视为无延迟
+
+    需要 REPLICATION CLIENT 权限，MySQL 8.0.22 之前的版本使用 SHOW SLAVE STATUS
+    """
+    if engine.dialect.name not in ("mysql", "mariadb"):
+        return 0
+    with engine.connect() as conn:
+        try:
+            row = conn.exec_driver_sql("SHOW REPLICA STATUS").mappings().first()
+        except DBAPIError as e:
+            if mysql_errno(e) != ER_PARSE_ERROR:
+                raise
+            conn.rollback()
+            row = conn.exec_driver_sql("SHOW SLAVE STATUS").mappings().first()
+    if row is None:
+        return 0
+    return row.get("Seconds_Behind_Source", row.get("Seconds_Behind_Master"))
+
+
+router = ReplicaRouter()
+
+
+def run_read(fn):
+    """在只读副本的会话上执行 fn(session) 并返回其结果，副本出错时在主库重试
+
+    fn 可能被执行两次，只应包含查询；返回值应在会话内处理完毕，不依赖会话中的ORM对象
+    """
+    engine = router.pick()
+    if engine is not None:
+        try:
+            with Session(engine) as session:
+                return fn(session)
+        except OperationalError as e:
+            logger.error(f"Read from replica failed, retry on primary. [{e}]")
+            router.mark_down(engine)
+    with Session(db.engine) as session:
+        return fn(session)
+
+
+def read_scalars(stmt):
+    """在只读副本上执行查询并返回全部ORM对象，副本出错时在主库重试
+
+    返回的对象已与会话分离，需要的关联关系应在查询中预先加载
+    """
+    engine = router.pick()
+    if engine is not None:
+        try:
+            with Session(engine) as session:
+                return session.execute(stmt).scalars().all()
+        except OperationalError as e:
+            logger.error(f"Read from replica failed, retry on primary. [{e}]")
+            router.mark_down(engine)
+    return db.session.execute(stmt).scalars().all()
@@ -0,0 +1,167 @@
+import heapq
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from flask import g, current_app
+from sqlalchemy import select, update, or_, and_
+from sqlalchemy.exc import SQLAlchemyError
+from messagebus import db
+from messagebus.codec import loads
+from messagebus.models import Message, Schedule
+
+logger = logging.getLogger('MBus')
+
+
+class Scheduler:
+    """ 定时/延时消息调度器
+        按批从 schedule 表认领未来 lookahead 秒内到期的计划放入最小堆，
+        到期后交给线程池投递。堆中只保留时间窗口内的计划，数据库中可以积压任意数量的待发消息。
+        多实例部署时通过 owner 字段认领，避免重复投递；认领后超过 claim_timeout 未完成的计划会被重新认领。
+    """
+
+    def __init__(self):
+        self.app = None
+        self.conf = {}
+        self.heap = []
+        self.owner = f"{socket.gethostname()[:32]}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.batch_seq = 0
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.executor = None
+        self.thread = None
+
+    def init_app(self, app):
+        conf = app.config.get("scheduler") or {}
+        # 多节点部署时可只在部分节点运行调度循环（run为false），其它节点只接收定时消息
+        if not conf.get("enabled") or not conf.get("run", True):
+            return
+        self.app = app
+        self.conf = conf
+        self.executor = ThreadPoolExecutor(max_workers=conf.get("workers", 4),
+                                           thread_name_prefix="MBusDispatch")
+        self.thread = threading.Thread(target=self.run, name="MBusScheduler", daemon=True)
+        self.thread.start()
+        logger.info(f"Scheduler {self.owner} started.")
+
+    @staticmethod
+    def accepting():
+        """是否接收定时/延时消息，配置热加载后即时生效"""
+        return bool((current_app.config.get("scheduler") or {}).get("enabled"))
+
+    def notify(self, due_at):
+        """新的计划落在当前时间窗口内时立即重新加载，而不必等到下一次轮询"""
+        if self.thread and due_at <= datetime.now() + timedelta(seconds=self.conf.get("lookahead", 60)):
+            self.wakeup.set()
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+        if self.thread:
+            self.thread.join()
+            self.executor.shutdown(wait=True)
+
+    def run(self):
+        next_load = 0
+        while not self.stopped.is_set():
+            if self.wakeup.is_set():
+                self.wakeup.clear()
+                next_load = 0
+            if time.monotonic() >= next_load:
+                try:
+                    full = self.load(datetime.now())
+                except SQLAlchemyError:
+                    logger.exception("Failed to load schedules.")
+                    full = False
+                # 一批装满说明还有积压，立即继续加载
+                next_load = time.monotonic() + (0 if full else self.conf.get("poll_interval", 5))
+
+            now = datetime.now()
+            while self.heap and self.heap[0][0] <= now:
+                _, sid, message_uuid, token = heapq.heappop(self.heap)
+                self.executor.submit(self.release, sid, message_uuid, token)
+
+            timeout = next_load - time.monotonic()
+            if self.heap:
+                timeout = min(timeout, (self.heap[0][0] - datetime.now()).total_seconds())
+            self.wakeup.wait(max(timeout, 0))
+
+    def load(self, now):
+        """认领一批即将到期的计划放入堆中，返回是否装满了一批"""
+        batch_size = self.conf.get("batch_size", 1000)
+        capacity = self.conf.get("max_pending", 100000) - len(self.heap)
+        if capacity <= 0:
+            return False
+
+        horizon = now + timedelta(seconds=self.conf.get("lookahead", 60))
+        stale = now - timedelta(seconds=self.conf.get("claim_timeout", 600))
+        claimable = or_(Schedule.status == "pending",
+                        and_(Schedule.status == "queued", Schedule.claimed_at < stale))
+        self.batch_seq += 1
+        token = f"{self.owner}:{self.batch_seq}"
+
+        with self.app.app_context():
+            stmt = select(Schedule.id).where(
+                Schedule.due_at <= horizon, claimable
+            ).order_by(Schedule.due_at).limit(min(batch_size, capacity))
+            ids = db.session.execute(stmt).scalars().all()
+            if not ids:
+                return False
+
+            stmt = update(Schedule).where(
+                Schedule.id.in_(ids), claimable
+            ).values(
+                status="queued",
+                owner=token,
+                claimed_at=now
+            )
+            db.session.execute(stmt)
+            db.session.commit()
+
+            stmt = select(Schedule.due_at, Schedule.id, Schedule.uuid, Schedule.owner).where(
+                Schedule.id.in_(ids), Schedule.owner == token
+            )
+            for row in db.session.execute(stmt):
+                heapq.heappush(self.heap, tuple(row))
+            logger.debug(f"Scheduler loaded {len(ids)} schedules due before {horizon}.")
+
+        return len(ids) == batch_size
+
+    def release(self, sid, message_uuid, token):
+        """到期投递：按投递时刻的订阅关系计算接收者并发送，仅在仍持有认领（owner为token）时更新状态"""
+        from messagebus.mbc import MessageBus
+        from messagebus.message.message import resolve_recipients, dispatch
+
+        with self.app.app_context():
+            g.uuid = message_uuid
+            try:
+                schedule = db.session.get(Schedule, sid)
+                if schedule is None or schedule.owner != token:
+                    logger.warning(f"Schedule of message {message_uuid} has been reclaimed, skipped.")
+                    return
+                message = db.session.execute(select(Message).where(Message.uuid == message_uuid)).scalar()
+                extra = loads(schedule.extra) if schedule.extra else None
+                mbus = MessageBus.from_config(self.app.config)
+                channel = dispatch(mbus, message, resolve_recipients(message, extra))
+                if channel:
+                    logger.warning(f"Message {message_uuid} has no recipient in {channel}.")
+                    status = "failed"
+                else:
+                    status = "completed"
+            except Exception:
+                logger.exception(f"Failed to send scheduled message {message_uuid}.")
+                db.session.rollback()
+                status = "failed"
+
+            stmt = update(Schedule).where(Schedule.id == sid, Schedule.owner == token).values(status=status)
+            if db.session.execute(stmt).rowcount != 1:
+                logger.warning(f"Schedule of message {message_uuid} has been reclaimed by another scheduler.")
+            elif status == "failed":
+                db.session.execute(update(Message).where(Message.uuid == message_uuid).values(status="failed"))
+            db.session.commit()
+
+scheduler = Scheduler()
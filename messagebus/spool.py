@@ -0,0 +1,282 @@
+import fcntl
+import glob
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from flask import g
+from sqlalchemy import text, update
+from sqlalchemy.exc import IntegrityError, OperationalError, InterfaceError
+from messagebus import db
+from messagebus.codec import dumps, loads
+from messagebus.models import Message
+
+logger = logging.getLogger('MBus')
+
+# 记录头：负载长度、负载crc32。长度为0表示段结束（mmap预分配的空白区）
+HEADER = struct.Struct("<II")
+
+
+def read_records(f, offset=0):
+    """从段文件offset处顺序读取记录，遇到空白、截断或校验失败的记录即停止
+
+    :return: (记录, 该记录结束位置) 的迭代器
+    """
+    f.seek(offset)
+    while True:
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return
+        length, crc = HEADER.unpack(header)
+        if length == 0:
+            return
+        payload = f.read(length)
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            logger.error(f"Spool segment {f.name} is truncated at {offset}.")
+            return
+        offset += HEADER.size + length
+        yield loads(payload), offset
+
+
+class Segment:
+    """ 正在写入的段文件
+        mmap模式下预分配文件并映射写入，封存时截断到实际长度
+    """
+
+    def __init__(self, path, size, use_mmap):
+        self.path = path
+        self.offset = 0
+        self.opened_at = time.monotonic()
+        self.mm = None
+        if use_mmap:
+            self.file = open(path, "w+b")
+            self.file.truncate(size)
+            self.mm = mmap.mmap(self.file.fileno(), size)
+            self.capacity = size
+        else:
+            self.file = open(path, "ab", buffering=0)
+            self.capacity = None
+
+    def fits(self, n):
+        return self.capacity is None or self.offset + n <= self.capacity
+
+    def write(self, data):
+        if self.mm is not None:
+            self.mm[self.offset:self.offset + len(data)] = data
+        else:
+            self.file.write(data)
+        self.offset += len(data)
+
+    def sync(self):
+        if self.mm is not None:
+            self.mm.flush()
+        else:
+            os.fsync(self.file.fileno())
+
+    def seal(self):
+        """落盘并关闭，改名为.seg后可被回放"""
+        self.sync()
+        if self.mm is not None:
+            self.mm.close()
+            self.file.truncate(self.offset)
+        self.file.close()
+        os.replace(self.path, self.path[:-len(".open")] + ".seg")
+
+
+class Spool:
+    """ 本地预写缓冲
+        /message 请求先追加到本地段文件，按批fsync后即返回，回放线程在数据库可用时把消息写库并投递。
+        段文件按大小或时间封存，多进程各自写自己的段，回放时用文件锁保证同一段只被一个进程处理。
+    """
+
+    def __init__(self):
+        self.app = None
+        self.conf = {}
+        self.path = None
+        self.segment = None
+        self.written = 0
+        self.synced = 0
+        self.lock = threading.Lock()
+        self.synced_cond = threading.Condition(self.lock)
+        self.sync_lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    @property
+    def enabled(self):
+        return self.app is not None
+
+    def init_app(self, app):
+        conf = app.config.get("spool") or {}
+        if not conf.get("enabled"):
+            return
+        self.app = app
+        self.conf = conf
+        self.path = conf.get("path", "spool")
+        os.makedirs(self.path, exist_ok=True)
+        self.recover()
+        with self.lock:
+            self.roll()
+        threading.Thread(target=self.flush_loop, name="MBusSpoolFlusher", daemon=True).start()
+        threading.Thread(target=self.drain_loop, name="MBusSpoolDrainer", daemon=True).start()
+        logger.info(f"Spool enabled at {self.path}.")
+
+    def append(self, record):
+        """追加一条记录，开启fsync时等待其所在批次落盘后返回"""
+        payload = dumps(record).encode("utf-8")
+        data = HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        with self.lock:
+            if not self.segment.fits(len(data)) or self.segment.offset >= self.conf.get("segment_size", 64 << 20):
+                self.roll(len(data))
+            self.segment.write(data)
+            self.written += 1
+            seq = self.written
+            if self.conf.get("fsync", True):
+                while self.synced < seq:
+                    self.synced_cond.wait()
+
+    def roll(self, need=0):
+        """封存当前段并打开新段，调用方需持有self.lock"""
+        with self.sync_lock:
+            if self.segment is not None:
+                self.segment.seal()
+                self.synced = self.written
+                self.synced_cond.notify_all()
+            name = f"{time.time_ns():020d}-{os.getpid()}.open"
+            size = max(self.conf.get("segment_size", 64 << 20), need)
+            self.segment = Segment(os.path.join(self.path, name), size, self.conf.get("mmap", False))
+
+    def flush_loop(self):
+        """批量落盘：每fsync_interval毫秒对新写入的记录做一次fsync，超过seal_interval的非空段被封存"""
+        interval = self.conf.get("fsync_interval", 10) / 1000
+        while not self.stopped.wait(interval):
+            with self.lock:
+                segment, target = self.segment, self.written
+                if segment.offset and time.monotonic() - segment.opened_at >= self.conf.get("seal_interval", 1):
+                    self.roll()
+                    continue
+            if target <= self.synced:
+                continue
+            with self.sync_lock:
+                if segment is self.segment:
+                    segment.sync()
+            with self.lock:
+                self.synced = max(self.synced, target)
+                self.synced_cond.notify_all()
+
+    def recover(self):
+        """把已退出进程遗留的.open段封存，以便回放"""
+        for path in glob.glob(os.path.join(self.path, "*.open")):
+            pid = int(os.path.basename(path).split("-")[1].split(".")[0])
+            if self.segment is not None and path == self.segment.path:
+                continue
+            if pid != os.getpid() and pid_alive(pid):
+                continue
+            os.replace(path, path[:-len(".open")] + ".seg")
+            logger.info(f"Recovered spool segment {path}.")
+
+    def backlog(self):
+        """待回放的字节数：已封存段扣除回放进度，加上本进程正在写入的段"""
+        if not self.enabled:
+            return 0
+        total = self.segment.offset if self.segment is not None else 0
+        for path in glob.glob(os.path.join(self.path, "*.seg")):
+            try:
+                size = os.path.getsize(path)
+                with open(path + ".ckpt", "r") as c:
+                    size -= int(c.read() or 0)
+            except (FileNotFoundError, ValueError):
+                # 已回放完删除，或尚无回放进度
+                pass
+            total += max(size, 0)
+        return total
+
+    def drain_loop(self):
+        retry_interval = self.conf.get("retry_interval", 5)
+        while not self.stopped.is_set():
+            with self.lock:
+                self.recover()
+            segments = sorted(glob.glob(os.path.join(self.path, "*.seg")))
+            if not segments:
+                self.stopped.wait(self.conf.get("drain_interval", 0.5))
+                continue
+            try:
+                with self.app.app_context():
+                    db.session.execute(text("SELECT 1"))
+                for segment in segments:
+                    self.drain(segment)
+            except (OperationalError, InterfaceError) as e:
+                logger.error(f"Database is unavailable, spool drain paused. [{e}]")
+                self.stopped.wait(retry_interval)
+
+    def drain(self, path):
+        """回放一个段，进度记录在.ckpt中，全部完成后删除段文件"""
+        checkpoint = path + ".ckpt"
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return
+        with f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            # 加锁前可能已被其它进程处理完
+            if not os.path.exists(path):
+                return
+            offset = 0
+            if os.path.exists(checkpoint):
+                with open(checkpoint, "r") as c:
+                    offset = int(c.read() or 0)
+            for record, offset in read_records(f, offset):
+                self.replay(record)
+                with open(checkpoint, "w") as c:
+                    c.write(str(offset))
+            os.remove(path)
+        if os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        logger.debug(f"Spool segment {path} has been drained.")
+
+    def replay(self, record):
+        """按同步接口的流程处理一条缓冲的消息，数据库不可用时抛出异常以暂停回放"""
+        from messagebus.mbc import MessageBus
+        from messagebus.message.message import handle_message, resume_message
+
+        with self.app.app_context():
+            g.uuid = record["uuid"]
+            try:
+                g.mbus = MessageBus.from_config(self.app.config)
+                try:
+                    handle_message(record["data"])
+                except IntegrityError:
+                    # 此前已回放过（uuid唯一），入库后未完成投递的继续投递；scheduled的消息与计划同时入库，由调度器投递
+                    db.session.rollback()
+                    logger.info(f"Spooled message {record['uuid']} has already been stored.")
+                    if resume_message(record["data"]):
+                        logger.info(f"Spooled message {record['uuid']} has been resumed.")
+            except (OperationalError, InterfaceError):
+                db.session.rollback()
+                raise
+            except Exception:
+                db.session.rollback()
+                logger.exception(f"Failed to replay spooled message {record['uuid']}.")
+                # 客户端已收到202，置为failed以便通过 GET /messages 查到
+                db.session.execute(update(Message).where(
+                    Message.uuid == record["uuid"], Message.status == "created"
+                ).values(status="failed"))
+                db.session.commit()
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+spool = Spool()